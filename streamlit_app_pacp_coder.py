@@ -1,7 +1,9 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import io
 import re
+from collections import Counter
 
 # ===== default unwanted codes (same as your earlier version) =====
 DEFAULT_UNWANTED_STR = (
@@ -9,173 +11,268 @@ DEFAULT_UNWANTED_STR = (
     "TB, TBA, TBC, TBD, TF, TFA, TFC, TFD, TS, TSA"
 )
 
-def parse_unwanted(text: str) -> set:
+# one output row per inspection / segment
+KEY_COLS = ["InspectionID", "Pipe_Segment_Reference"]
+
+# code columns are text; skip type inference on them
+CONDITION_DTYPES = {"PACP_Code": "string", "Continuous": "string"}
+
+# columns joined in from inspections / ratings (by InspectionID)
+INSP_COLS = [
+    "Pipe_Segment_Reference",
+    "Inspection_Date",
+    "Street",
+    "City",
+    "Length_Surveyed",
+    "Height",
+    "Material",
+    "Upstream_MH",
+    "Downstream_MH",
+]
+RATE_COLS = ["STQuickRating", "OMQuickRating", "OverallPipeRatingsIndex"]
+
+# repeated text / id columns, stored as category after merging
+# (PACP_Code / Continuous are already categories from _clean_codes)
+CATEGORY_COLS = [
+    "InspectionID",
+    "Pipe_Segment_Reference",
+    "Street",
+    "City",
+    "Material",
+]
+
+# per-inspection columns carried through from inspections / ratings
+META_COLS = [
+    "Inspection_Date",
+    "Street",
+    "City",
+    "Length_Surveyed",
+    "Height",
+    "Material",
+    "Upstream_MH",
+    "Downstream_MH",
+    "STQuickRating",
+    "OMQuickRating",
+    "OverallPipeRatingsIndex",
+]
+
+# rows shown in the on-page table (downloads always have everything)
+PREVIEW_ROWS = 200
+
+# output columns ahead of PACP_Code1..N
+OUT_META_COLS = [
+    "InspectionID",
+    "Pipe_Segment_Reference",
+    "Inspection_Date",
+    "Street",
+    "City",
+    "Length_Surveyed",
+    "Diameter",
+    "Material",
+    "Upstream_MH",
+    "Downstream_MH",
+    "STR Score",
+    "OM Scores",
+    "Overall Scores",
+]
+
+# separators in the unwanted-codes text box (commas and/or whitespace)
+_CODE_SEP_RE = re.compile(r"[,\s]+")
+
+# frozenset is immutable → cache_resource hands back the same object, no copy;
+# max_entries because cache_resource never evicts on its own
+@st.cache_resource(show_spinner=False, max_entries=16)
+def parse_unwanted(text: str) -> frozenset:
     codes = set()
-    for tok in re.split(r"[,\s]+", text.strip()):
+    for tok in _CODE_SEP_RE.split(text.strip()):
         tok = tok.strip().upper()
         if tok:
             codes.add(tok)
-    return codes
+    return frozenset(codes)
 
-def process_codes(df: pd.DataFrame, unwanted_codes: set):
+def _pair_continuous(grp_ids: np.ndarray, code_ids: np.ndarray, kinds: np.ndarray, num_ids: np.ndarray) -> np.ndarray:
     """
-    Build the code list for ONE inspection/segment:
-      - normalize codes to UPPER + strip
-      - drop unwanted on the normalized code
-      - detect S/F continuous pairs on normalized code
+    S/F continuous pairs for ALL inspections/segments at once:
+      - kinds: 0 = S, 1 = F, -1 = not continuous
+      - last S / last F per (group, code, num) wins, like the old dict lookups
+      - S rows hash-joined to F rows on (group, code, num)
+      - returns a bool mask of the rows that belong to a matched pair
+    """
+    sf = pd.DataFrame({"grp": grp_ids, "code": code_ids, "num": num_ids, "kind": kinds})
+    sf = sf[(sf["grp"] >= 0) & (sf["code"] >= 0) & (sf["kind"] >= 0)].drop_duplicates(keep="last")
+
+    pair_keys = ["grp", "code", "num"]
+    pairs = sf[sf["kind"] == 0].reset_index().merge(
+        sf[sf["kind"] == 1].reset_index(), on=pair_keys, suffixes=("_s", "_f")
+    )
+
+    used = np.zeros(len(grp_ids), dtype=bool)
+    used[pairs["index_s"].to_numpy()] = True
+    used[pairs["index_f"].to_numpy()] = True
+    return used
+
+def process_codes(code_ids: np.ndarray, used: np.ndarray, code_vocab) -> list:
+    """
+    Build the code list for ONE inspection/segment from its factorized
+    codes and S/F pair mask (see process_files):
+      - missing / unwanted codes are already dropped
+      - used marks rows in a continuous S/F pair (_pair_continuous)
       - for non-continuous counts, DO NOT include S/F rows
     """
-    # make a working copy with normalized columns
-    work = df.copy()
-    work["code_clean"] = work["PACP_Code"].astype(str).str.strip().str.upper()
-    work["cont_clean"] = work.get("Continuous", "").astype(str).str.strip().str.upper()
-
-    # filter unwanted on cleaned code
-    work = work[~work["code_clean"].isin(unwanted_codes) & work["code_clean"].notna()]
-    if work.empty:
-        return []
-
-    so_lookup, fo_lookup = {}, {}
-    used_indices = set()
-    continuous_counts = {}
-
-    # 1) build S/F lookups on cleaned code
-    for idx, row in work.iterrows():
-        code = row["code_clean"]
-        cont = row["cont_clean"]
-        if cont.startswith("S"):
-            so_lookup[(code, cont[1:])] = idx
-        elif cont.startswith("F"):
-            fo_lookup[(code, cont[1:])] = idx
-
-    # 2) match S/F pairs
-    for (code, num), s_idx in so_lookup.items():
-        if (code, num) in fo_lookup:
-            f_idx = fo_lookup[(code, num)]
-            continuous_counts[code] = continuous_counts.get(code, 0) + 1
-            used_indices.update([s_idx, f_idx])
-
-    # 3) rows that are NOT in S/F pairs = real non-continuous rows
-    noncont_df = work[~work.index.isin(used_indices)]
+    # fast path: no S/F pairs in this group (the common case) →
+    # plain counts in first-seen order (Counter keeps insertion order)
+    if not used.any():
+        counts = Counter(code_ids.tolist())
+        return [code_vocab[cid] if n == 1 else f"{code_vocab[cid]} X{n}" for cid, n in counts.items()]
+
+    # every pair marks two rows
+    continuous_counts = {c: n // 2 for c, n in zip(*np.unique(code_ids[used], return_counts=True))}
+    noncont_counts = dict(zip(*np.unique(code_ids[~used], return_counts=True)))
 
     final = []
     seen_cont = set()
     seen_noncont = set()
 
-    # 4) walk original filtered order
-    for idx, row in work.iterrows():
-        code = row["code_clean"]
+    # walk original filtered order
+    for cid, is_used in zip(code_ids.tolist(), used.tolist()):
+        code = code_vocab[cid]
 
-        if idx in used_indices:
+        if is_used:
             # part of a continuous pair
-            if code not in seen_cont:
-                pair_count = continuous_counts.get(code, 1)
+            if cid not in seen_cont:
+                pair_count = continuous_counts[cid]
                 # show © or ©Xn
                 final.append(f"{code} ©" if pair_count == 1 else f"{code} ©X{pair_count}")
-                seen_cont.add(code)
+                seen_cont.add(cid)
         else:
-            # non-continuous → count ONLY among noncont_df
-            if code not in seen_noncont:
-                noncont_count = (noncont_df["code_clean"] == code).sum()
+            # non-continuous → count ONLY among non-paired rows
+            if cid not in seen_noncont:
+                noncont_count = noncont_counts[cid]
                 final.append(f"{code} X{noncont_count}" if noncont_count > 1 else code)
-                seen_noncont.add(code)
+                seen_noncont.add(cid)
 
     return final
 
-def process_files(conditions_xl, inspections_xl, ratings_xl, unwanted_codes: set) -> pd.DataFrame:
-    # read
-    df_conditions = pd.read_excel(conditions_xl)
-    df_inspections = pd.read_excel(inspections_xl)
-    df_ratings = pd.read_excel(ratings_xl)
-
-    # merge inspections (PSR + meta)
-    df_merged = df_conditions.merge(
-        df_inspections[
-            [
-                "InspectionID",
-                "Pipe_Segment_Reference",
-                "Inspection_Date",
-                "Street",
-                "City",
-                "Length_Surveyed",
-                "Height",
-                "Material",
-                "Upstream_MH",
-                "Downstream_MH",
-            ]
-        ],
-        on="InspectionID",
-        how="left",
+def _clean_codes(col: pd.Series) -> pd.Series:
+    """
+    UPPER + strip a code column, returned as a category:
+      - the string work runs once per distinct value, not once per row
+      - categories are the cleaned codes (unique), missing stays missing
+    """
+    cat = col.astype("category")
+    clean = cat.cat.categories.astype("string").str.strip().str.upper()
+    cat_ids, vocab = pd.factorize(clean)
+    # trailing -1 so missing rows (cat code -1) stay -1
+    codes = np.append(cat_ids, -1)[cat.cat.codes.to_numpy()]
+    return pd.Series(pd.Categorical.from_codes(codes, categories=vocab), index=col.index, name=col.name)
+
+def process_files(conditions_xl, inspections_xl, ratings_xl, unwanted_codes: frozenset) -> pd.DataFrame:
+    # read (calamine: native xlsx/xls parser, much faster than openpyxl)
+    df_conditions = pd.read_excel(conditions_xl, engine="calamine", dtype=CONDITION_DTYPES)
+    df_inspections = pd.read_excel(inspections_xl, engine="calamine")
+    df_ratings = pd.read_excel(ratings_xl, engine="calamine")
+
+    # normalize codes once at read time (UPPER + strip); nothing downstream re-cleans
+    for col in ("PACP_Code", "Continuous"):
+        if col in df_conditions:
+            df_conditions[col] = _clean_codes(df_conditions[col])
+
+    # join inspections (PSR + meta) and ratings, both indexed on InspectionID
+    insp_small = df_inspections.set_index("InspectionID")[INSP_COLS]
+    rate_small = df_ratings.set_index("InspectionID")[RATE_COLS]
+    df_merged = df_conditions.join(insp_small, on="InspectionID").join(rate_small, on="InspectionID")
+
+    # low-cardinality, repeated columns → category (int codes for groupby / isin)
+    for col in CATEGORY_COLS:
+        if col in df_merged:
+            df_merged[col] = df_merged[col].astype("category")
+
+    # category codes as ids: code → id (-1 = missing/unwanted),
+    # continuous "S01"/"F01" → kind (0/1, -1 = none) + num id
+    code_vocab = df_merged["PACP_Code"].cat.categories
+    # np.where, not in-place: cat.codes can be read-only (e.g. an empty frame)
+    codes = df_merged["PACP_Code"].cat.codes.to_numpy()
+    code_ids = np.where(np.isin(codes, np.flatnonzero(code_vocab.isin(unwanted_codes))), -1, codes)
+
+    cont = df_merged.get("Continuous", pd.Series(index=df_merged.index, dtype="category"))
+    cont_vocab = cont.cat.categories.astype("string")
+    cont_ids = cont.cat.codes.to_numpy()
+    cont_kind = cont_vocab.str[0].map({"S": 0, "F": 1}).fillna(-1).to_numpy(dtype=np.int8)
+    cont_num = pd.factorize(cont_vocab.str[1:])[0]
+    kinds = np.append(cont_kind, -1)[cont_ids]
+    num_ids = np.append(cont_num, -1)[cont_ids]
+    code_vocab = code_vocab.tolist()
+
+    # no key sort / MultiIndex here; the output is sorted once at the end
+    groups = df_merged.groupby(KEY_COLS, sort=False, as_index=False, observed=True)
+
+    # S/F pairs for every group in one join (rows outside any group → -1)
+    grp_ids = groups.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    used = _pair_continuous(grp_ids, code_ids, kinds, num_ids)
+
+    # per-inspection meta in one pass (one row per group, in ngroup order)
+    meta = groups[META_COLS].first()
+
+    # kept rows laid out group by group (stable → original order inside a
+    # group), so each group's arrays are slices (views), not copies
+    kept = np.flatnonzero((grp_ids >= 0) & (code_ids >= 0))
+    order = kept[np.argsort(grp_ids[kept], kind="stable")]
+    grp_sorted = grp_ids[order]
+    code_sorted = code_ids[order]
+    used_sorted = used[order]
+    starts = np.flatnonzero(np.diff(grp_sorted, prepend=-1))
+    ends = np.append(starts[1:], len(order))
+
+    # long (group, i, code) rows → pivoted to PACP_Code1..N at the end
+    long_rows = []
+    for grp, a, b in zip(grp_sorted[starts].tolist(), starts, ends):
+        codes = process_codes(code_sorted[a:b], used_sorted[a:b], code_vocab)
+        long_rows.extend((grp, i, code) for i, code in enumerate(codes, start=1))
+
+    # keep your original style: just zfill the string, don't int()
+    meta["STR Score"] = meta["STQuickRating"].astype("string").str.zfill(4).fillna("0000")
+    meta["OM Scores"] = meta["OMQuickRating"].astype("string").str.zfill(4).fillna("0000")
+    # length surveyed / overall → 2 decimals if numeric
+    # (Python round(), not Series.round(): NumPy rounds halves like 12.345 differently)
+    meta["Length_Surveyed"] = pd.to_numeric(meta["Length_Surveyed"], errors="coerce").astype("float64").map(lambda v: round(v, 2))
+    meta["Overall Scores"] = pd.to_numeric(meta["OverallPipeRatingsIndex"], errors="coerce").astype("float64").map(lambda v: round(v, 2))
+
+    codes_df = pd.DataFrame(long_rows, columns=["grp", "i", "code"]).pivot(
+        index="grp", columns="i", values="code"
     )
+    codes_df.columns = [f"PACP_Code{i}" for i in codes_df.columns]
 
-    # merge ratings
-    df_merged = df_merged.merge(
-        df_ratings[
-            [
-                "InspectionID",
-                "STQuickRating",
-                "OMQuickRating",
-                "OverallPipeRatingsIndex",
-            ]
-        ],
-        on="InspectionID",
-        how="left",
+    # meta rows are in group-number order, so its index is the group id
+    meta = meta.rename(columns={"Height": "Diameter"})[OUT_META_COLS]
+    return meta.join(codes_df).sort_values(KEY_COLS, ignore_index=True)
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _process_files_cached(cond_bytes: bytes, insp_bytes: bytes, rate_bytes: bytes, unwanted_key: tuple) -> pd.DataFrame:
+    """
+    process_files memoized on the uploaded file contents:
+      - re-clicking Process with the same uploads/codes skips all work
+      - unwanted_key is the sorted code tuple (stable cache hash)
+    """
+    return process_files(
+        io.BytesIO(cond_bytes),
+        io.BytesIO(insp_bytes),
+        io.BytesIO(rate_bytes),
+        frozenset(unwanted_key),
     )
 
-    out_rows = []
-    for (insp_id, psr), group in df_merged.groupby(["InspectionID", "Pipe_Segment_Reference"]):
-        codes = process_codes(group, unwanted_codes)
-
-        stquick_val = group["STQuickRating"].iloc[0]
-        omquick_val = group["OMQuickRating"].iloc[0]
-        overall_val = group["OverallPipeRatingsIndex"].iloc[0]
-
-        # keep your original style: just zfill the string, don't int()
-        str_score = str(stquick_val).zfill(4) if pd.notna(stquick_val) else "0000"
-        om_score  = str(omquick_val).zfill(4) if pd.notna(omquick_val) else "0000"
-
-        # length surveyed → 2 decimals
-        ls_val = group["Length_Surveyed"].iloc[0]
-        if pd.notna(ls_val):
-            try:
-                ls_val = round(float(ls_val), 2)
-            except Exception:
-                ls_val = None
-        else:
-            ls_val = None
-
-        # overall → 2 decimals if numeric
-        if pd.notna(overall_val):
-            try:
-                overall_fmt = round(float(overall_val), 2)
-            except Exception:
-                overall_fmt = None
-        else:
-            overall_fmt = None
-
-        row = {
-            "InspectionID": insp_id,
-            "Pipe_Segment_Reference": psr,
-            "Inspection_Date": group["Inspection_Date"].iloc[0],
-            "Street": group["Street"].iloc[0],
-            "City": group["City"].iloc[0],
-            "Length_Surveyed": ls_val,
-            "Diameter": group["Height"].iloc[0],
-            "Material": group["Material"].iloc[0],
-            "Upstream_MH": group["Upstream_MH"].iloc[0],
-            "Downstream_MH": group["Downstream_MH"].iloc[0],
-            "STR Score": str_score,
-            "OM Scores": om_score,
-            "Overall Scores": overall_fmt,
-        }
-
-        # add PACP_Code1..N
-        for i, code in enumerate(codes, start=1):
-            row[f"PACP_Code{i}"] = code
-
-        out_rows.append(row)
-
-    return pd.DataFrame(out_rows)
+@st.cache_data(show_spinner=False, max_entries=4)
+def _output_files(cond_bytes: bytes, insp_bytes: bytes, rate_bytes: bytes, unwanted_key: tuple) -> tuple:
+    """
+    (csv bytes, xlsx bytes) of the full output, memoized on the same inputs
+    as _process_files_cached so reruns don't rewrite the files:
+      - CSV: quickest to produce; BOM so Excel reads ©
+      - xlsx: xlsxwriter, faster and leaner than openpyxl
+    """
+    df_out = _process_files_cached(cond_bytes, insp_bytes, rate_bytes, unwanted_key)
+    buf = io.BytesIO()
+    with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
+        df_out.to_excel(writer, index=False, sheet_name="PACP_Output")
+    return df_out.to_csv(index=False).encode("utf-8-sig"), buf.getvalue()
 
 # =================== STREAMLIT UI ===================
 
@@ -206,22 +303,31 @@ if run:
 
     unwanted_set = parse_unwanted(unwanted_text)
 
+    inputs = (f_cond.getvalue(), f_insp.getvalue(), f_rate.getvalue(), tuple(sorted(unwanted_set)))
+
     try:
-        df_out = process_files(f_cond, f_insp, f_rate, unwanted_set)
+        df_out = _process_files_cached(*inputs)
+        csv_bytes, xlsx_bytes = _output_files(*inputs)
     except Exception as e:
         st.exception(e)
         st.stop()
 
     st.success(f"Processed {len(df_out)} inspection rows.")
-    st.dataframe(df_out, use_container_width=True)
+    # preview only; the downloads carry every row
+    st.dataframe(df_out.head(PREVIEW_ROWS), use_container_width=True)
+    if len(df_out) > PREVIEW_ROWS:
+        st.caption(f"Showing the first {PREVIEW_ROWS} rows — download for all {len(df_out)}.")
 
     # download
-    buf = io.BytesIO()
-    df_out.to_excel(buf, index=False, sheet_name="PACP_Output")
-    buf.seek(0)
+    st.download_button(
+        "Download PACP_Output.csv",
+        data=csv_bytes,
+        file_name="PACP_Output.csv",
+        mime="text/csv",
+    )
     st.download_button(
         "Download PACP_Output.xlsx",
-        data=buf,
+        data=xlsx_bytes,
         file_name="PACP_Output.xlsx",
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
     )